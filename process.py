@@ -1,39 +1,475 @@
 #!/usr/bin/env python
 import os
 import re
+import sys
+import json
+import random
+import uuid
 import yaml
-from github import Github
+from github import Consts, Github, GithubException, GithubIntegration, \
+    RateLimitExceededException
+from github.PullRequest import PullRequest
 import sqlite3
 import datetime
+import math
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 from dateutil import parser as dtp
 import parsedatetime
 import argparse
 import logging
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO)
 log = logging.getLogger()
 logging.getLogger('github').setLevel(logging.INFO)
 
-gh = Github(
-    login_or_token=os.environ.get('GITHUB_USERNAME', None) or os.environ.get('GITHUB_OAUTH_TOKEN', None),
-    password=os.environ.get('GITHUB_PASSWORD', None),
-)
 
-log.warn("GH API RATE LIMIT: %s/%s" % gh.rate_limiting)
+class PooledClient(object):
+    """One GitHub identity (token or App installation) in a ClientPool.
+
+    `connect` returns a (credentials, expires_at) pair: keyword arguments
+    for `factory`, and None for tokens that don't expire. Credentials are
+    renewed shortly before they do otherwise.
+
+    PyGithub clients aren't thread safe, so each thread gets its own
+    client, sharing the credentials and usage count.
+    """
+
+    def __init__(self, label, connect, factory=Github):
+        self.label = label
+        self.connect = connect
+        self.factory = factory
+        self.credentials = None
+        self.expires_at = None
+        # Bumped whenever the credentials are renewed
+        self.generation = 0
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # Requests made through this identity, as far as we've seen
+        self.used = 0
+        self.last_seen = None
+        # When checking our quota last failed, if it did
+        self.failed_at = None
+
+    def client(self):
+        with self.lock:
+            if self.credentials is None or (
+                    self.expires_at is not None and
+                    datetime.datetime.utcnow() >= self.expires_at - datetime.timedelta(minutes=5)):
+                self.credentials, self.expires_at = self.connect()
+                self.generation += 1
+            generation = self.generation
+
+        if getattr(self.local, 'generation', None) != generation:
+            self.local.gh = self.factory(**self.credentials)
+            # Repositories are bound to the old credentials
+            self.local.repos = {}
+            self.local.generation = generation
+        return self.local.gh
+
+    def get_repo(self, full_name):
+        # Reconnects first if needed, which forgets stale repositories
+        gh = self.client()
+        if full_name not in self.local.repos:
+            self.local.repos[full_name] = gh.get_repo(full_name)
+        return self.local.repos[full_name]
+
+    def quota(self, now):
+        """(remaining, limit, resettime), updating our usage count
+        """
+        gh = self.client()
+        remaining, limit = gh.rate_limiting
+        resettime = gh.rate_limiting_resettime
+        with self.lock:
+            # Threads may report what they last saw out of order, so only
+            # ever move forwards
+            if self.last_seen is None:
+                self.last_seen = (resettime, remaining)
+            else:
+                (last_resettime, last_remaining) = self.last_seen
+                if resettime == last_resettime and remaining < last_remaining:
+                    self.used += last_remaining - remaining
+                    self.last_seen = (resettime, remaining)
+                elif resettime > last_resettime:
+                    self.used += limit - remaining
+                    self.last_seen = (resettime, remaining)
+
+        if resettime <= now:
+            # Our information is stale, the quota has been reset since
+            remaining = limit
+        return remaining, limit, resettime
+
+
+class PooledRepository(object):
+    """Stand-in for a PyGithub Repository which sends each call through the
+    pool's reader with the most quota left, or through `client` if given,
+    using the calling thread's connection.
+    """
+
+    def __init__(self, pool, full_name, client=None):
+        self.pool = pool
+        self.full_name = full_name
+        self.client = client
+
+    def __getattr__(self, name):
+        client = self.pool.reader() if self.client is None else self.client
+        return getattr(client.get_repo(self.full_name), name)
+
+
+class ClientPool(object):
+    """Spreads read requests over several GitHub identities by remaining
+    quota and reset time. Writes should go through `writer` so they're made
+    as the bot_user, which comment deduplication relies on. The writer is
+    left out of reads if there are other clients, so they can't use up its
+    quota.
+
+    Quacks like Github for the rate_limiting attributes, summed over the
+    pool.
+    """
+
+    def __init__(self, clients, writer=None, retry_interval=600):
+        self.clients = clients
+        self.writer = clients[0] if writer is None else writer
+        self.readers = [client for client in clients if client is not self.writer] or [self.writer]
+        # Seconds to leave out a client whose quota couldn't be checked,
+        # e.g. because its token was revoked
+        self.retry_interval = retry_interval
+
+    @classmethod
+    def from_environment(cls, environ=os.environ):
+        """The bot's own credentials (GITHUB_USERNAME/GITHUB_PASSWORD or
+        GITHUB_OAUTH_TOKEN) are the writer. Reads are additionally spread
+        over comma separated GITHUB_OAUTH_TOKENS, and over
+        GITHUB_APP_INSTALLATION_IDS of the App with GITHUB_APP_ID and the
+        private key at GITHUB_APP_PRIVATE_KEY.
+        """
+        login = environ.get('GITHUB_USERNAME', None) or environ.get('GITHUB_OAUTH_TOKEN', None)
+        password = environ.get('GITHUB_PASSWORD', None)
+        writer = PooledClient(
+            'bot',
+            lambda: ({'login_or_token': login, 'password': password}, None)
+        )
+        clients = [writer]
+
+        for token in environ.get('GITHUB_OAUTH_TOKENS', '').split(','):
+            token = token.strip()
+            if token:
+                clients.append(PooledClient(
+                    'token ...' + token[-4:],
+                    # Bind token now, not when the lambda is called
+                    lambda token=token: ({'login_or_token': token}, None)
+                ))
+
+        if environ.get('GITHUB_APP_ID', None):
+            with open(environ['GITHUB_APP_PRIVATE_KEY'], 'r') as handle:
+                integration = GithubIntegration(environ['GITHUB_APP_ID'], handle.read())
+
+            def installation(installation_id):
+                auth = integration.get_access_token(installation_id)
+                return {'login_or_token': auth.token}, auth.expires_at
+
+            for installation_id in environ.get('GITHUB_APP_INSTALLATION_IDS', '').split(','):
+                installation_id = installation_id.strip()
+                if installation_id:
+                    clients.append(PooledClient(
+                        'installation ' + installation_id,
+                        lambda installation_id=int(installation_id): installation(installation_id)
+                    ))
+
+        return cls(clients, writer=writer)
+
+    def quotas(self, now, clients=None):
+        """Yield (client, (remaining, limit, resettime)) for each of
+        `clients` (all by default) whose quota can be checked. Those that
+        fail are logged and left out for retry_interval seconds.
+        """
+        for client in self.clients if clients is None else clients:
+            if client.failed_at is not None and now < client.failed_at + self.retry_interval:
+                continue
+            try:
+                quota = client.quota(now)
+            except GithubException, e:
+                log.error("[%s] Could not check the rate limit, leaving it out for %ss: %s",
+                          client.label, self.retry_interval, e)
+                client.failed_at = now
+                continue
+            client.failed_at = None
+            yield client, quota
+
+    def reader(self):
+        """The reader with the most quota left, or failing that the one
+        whose quota resets soonest. Falls back to the writer if no reader's
+        quota can be checked.
+        """
+        now = time.time()
+        best = None
+        best_key = None
+        for (client, (remaining, limit, resettime)) in self.quotas(now, self.readers):
+            key = (remaining, -resettime)
+            if best is None or key > best_key:
+                best = client
+                best_key = key
+        return self.writer if best is None else best
+
+    def get_repo(self, full_name):
+        return PooledRepository(self, full_name)
+
+    def get_writer_repo(self, full_name):
+        return PooledRepository(self, full_name, client=self.writer)
+
+    @property
+    def rate_limiting(self):
+        now = time.time()
+        remaining = 0
+        limit = 0
+        for (client, (client_remaining, client_limit, resettime)) in self.quotas(now):
+            remaining += client_remaining
+            limit += client_limit
+        return remaining, limit
+
+    @property
+    def rate_limiting_resettime(self):
+        now = time.time()
+        resettimes = [resettime for (client, (remaining, limit, resettime)) in self.quotas(now)]
+        return min(resettimes) if resettimes else now
+
+    def report(self):
+        """Log per-client API usage
+        """
+        now = time.time()
+        for (client, (remaining, limit, resettime)) in self.quotas(now):
+            log.info("[%s] used %s requests, %s/%s left", client.label, client.used, remaining, limit)
+
+
+gh = ClientPool.from_environment()
 
 
 UPVOTE_REGEX = '(:\+1:|^\s*\+1\s*$)'
 DOWNVOTE_REGEX = '(:\-1:|^\s*\-1\s*$)'
 
+# Typical API requests a condition or action makes per PR, used to estimate
+# the cost of a run. Anything not listed is free. These are estimates, not
+# bounds: comments are fetched 30 to a page, and remove_tag makes one
+# request per matching label.
+CONDITION_COST = {
+    'has_tag': 2,
+    'plus': 1,
+    'minus': 1,
+}
+ACTION_COST = {
+    'comment': 2,
+    'assign_next_milestone': 1,
+    'assign_tag': 1,
+    'remove_tag': 2,
+}
+# PRs per page of the listing
+PAGE_SIZE = 30
+
+# Bit flags for the vote(s) a single comment casts
+VOTE_UP = 1
+VOTE_DOWN = 2
+
+
+def classify_vote(body):
+    """Reduce a comment body to the VOTE_* flags it carries
+    """
+    vote = 0
+    if re.findall(UPVOTE_REGEX, body, re.MULTILINE):
+        vote |= VOTE_UP
+    if re.findall(DOWNVOTE_REGEX, body, re.MULTILINE):
+        vote |= VOTE_DOWN
+    return vote
+
+
+class PullRequestRecord(object):
+    """Compact stand-in for a PyGithub PullRequest.
+
+    Only the fields our conditions and actions look at are kept, so we don't
+    hold on to every PR's raw JSON for the length of a run. Comments are
+    reduced to (login, vote) tuples in `votes`, fetched lazily.
+    """
+    __slots__ = ('number', 'id', 'title', 'state', 'merged', 'base_ref',
+                 'milestone', 'user_login', 'created_at', 'updated_at',
+                 'votes')
+
+    def __init__(self, number, id, title, state, merged, base_ref,
+                 milestone, user_login, created_at, updated_at, votes=None):
+        self.number = number
+        self.id = id
+        self.title = title
+        self.state = state
+        self.merged = merged
+        self.base_ref = base_ref
+        self.milestone = milestone
+        self.user_login = user_login
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self.votes = votes
+
+    @classmethod
+    def from_github(cls, pr):
+        """Build a record from a PyGithub PullRequest
+        """
+        return cls(
+            number=pr.number,
+            id=pr.id,
+            title=pr.title,
+            state=pr.state,
+            # The listing endpoint doesn't include `merged`, and accessing it
+            # would trigger a full fetch of the PR. merged_at is listed.
+            merged=pr.merged_at is not None,
+            base_ref=pr.base.ref,
+            milestone=None if pr.milestone is None else pr.milestone.title,
+            user_login=pr.user.login,
+            created_at=pr.created_at,
+            updated_at=pr.updated_at,
+        )
+
+
+class Evaluation(object):
+    """A single PR's evaluation against all filters, as recorded in a
+    DecisionLog. A header event is always written, conditions are only
+    recorded if the evaluation was sampled.
+    """
+    __slots__ = ('decisions', 'id', 'repo', 'number', 'sampled')
+
+    def __init__(self, decisions, repo, number, sampled):
+        self.decisions = decisions
+        self.id = uuid.uuid4().hex[:12]
+        self.repo = repo
+        self.number = number
+        self.sampled = sampled
+        # So explain() knows this was the latest evaluation, even if
+        # nothing else is recorded for it
+        self.decisions.write({
+            'eval': self.id,
+            'time': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'repo': repo,
+            'pr': number,
+            'sampled': sampled,
+        })
+
+    def record(self, filter_name, condition, value, result, elapsed):
+        self.decisions.write({
+            'eval': self.id,
+            'repo': self.repo,
+            'pr': self.number,
+            'filter': filter_name,
+            'condition': condition,
+            'value': value,
+            'result': result,
+            'elapsed_ms': round(elapsed * 1000, 3),
+        })
+
+    def matched(self, filter_name):
+        """Matches are recorded whether sampled or not"""
+        self.decisions.write({
+            'eval': self.id,
+            'repo': self.repo,
+            'pr': self.number,
+            'filter': filter_name,
+            'condition': None,
+            'result': True,
+        })
+
+
+class DecisionLog(object):
+    """Buffered JSONL log of condition evaluations, one event per line.
+
+    Only a `sample` fraction of PR evaluations have their conditions
+    recorded, matches are always recorded. See explain() for reading it
+    back.
+    """
+
+    def __init__(self, path, sample=1.0, buffer_size=1000):
+        self.path = path
+        self.sample = sample
+        self.buffer_size = buffer_size
+        self.buffer = []
+        # Shared between repositories' threads
+        self.lock = threading.Lock()
+
+    def evaluation(self, repo, number):
+        return Evaluation(self, repo, number, random.random() < self.sample)
+
+    def write(self, event):
+        line = json.dumps(event, sort_keys=True, separators=(',', ':'), default=str)
+        with self.lock:
+            self.buffer.append(line)
+            if len(self.buffer) >= self.buffer_size:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.buffer:
+            return
+        with open(self.path, 'a') as handle:
+            handle.write('\n'.join(self.buffer) + '\n')
+        self.buffer = []
+
+
+def explain(path, number, repo=None):
+    """Rebuild why a PR did or didn't match each filter from its most recent
+    evaluation in the decision log at `path`. Returns lines of text.
+    """
+    if not os.path.exists(path):
+        return ["No decision log at %s yet" % path]
+
+    # Cheap check before parsing, relies on write()'s separators
+    needle = '"pr":%d,' % number
+    latest = {}
+    with open(path, 'r') as handle:
+        for line in handle:
+            if needle not in line:
+                continue
+            event = json.loads(line)
+            if repo is not None and event['repo'] != repo:
+                continue
+            if 'filter' not in event:
+                # Header, a new evaluation starts
+                latest[event['repo']] = [event]
+            else:
+                events = latest.get(event['repo'])
+                if events is not None and events[0]['eval'] == event['eval']:
+                    events.append(event)
+
+    if not latest:
+        return ["No decisions recorded for #%s" % number]
+
+    lines = []
+    for (event_repo, events) in sorted(latest.items()):
+        header = events[0]
+        if header['sampled']:
+            lines.append("%s#%s, latest evaluation at %s" % (event_repo, number, header['time']))
+        else:
+            lines.append("%s#%s, latest evaluation at %s was not sampled, only matches were recorded" % (
+                event_repo, number, header['time']))
+        for event in events[1:]:
+            if event['condition'] is None:
+                lines.append("  [%s] matched" % event['filter'])
+            else:
+                lines.append("  [%s] %s %s => %s (%s ms)%s" % (
+                    event['filter'], event['condition'], json.dumps(event['value']),
+                    event['result'], event['elapsed_ms'],
+                    '' if event['result'] else ', stopping'))
+    return lines
+
 
 class PullRequestFilter(object):
 
     def __init__(self, name, conditions, actions, committer_group=None,
-                 bot_user=None, dry_run=False, next_milestone=None, repo=None):
+                 bot_user=None, dry_run=False, next_milestone=None, repo=None,
+                 write_repo=None):
         self.name = name
         self.conditions = conditions
         self.actions = actions
         self.committer_group = [] if committer_group is None else committer_group
         self.repo = repo
+        # Repository bound to the bot_user's credentials, if reads use others
+        self.write_repo = write_repo
         self.bot_user = bot_user
         self.dry_run = dry_run
         self.next_milestone = next_milestone
@@ -44,27 +480,42 @@ class PullRequestFilter(object):
             for key in condition_dict:
                 yield (key, condition_dict[key])
 
-    def apply(self, pr):
+    def apply(self, pr, evaluation=None):
         """Apply a given PRF to a given PR. Causes all appropriate conditions
         to be evaluated for a PR, and then the appropriate actions to be
-        executed
+        executed. Results are recorded to `evaluation`, if given.
         """
-        log.debug("\t[%s]", self.name)
         try:
             self.issue = self.repo.get_issue(pr.number)
+        except RateLimitExceededException:
+            # Let run() stop, and keep the rest of its queue
+            raise
         except Exception, e:
             log.warn("Could not access issue")
             log.warn(e)
             return False
 
+        record = evaluation is not None and evaluation.sampled
         for (condition_key, condition_value) in self._condition_it():
-            res = self.evaluate(pr, condition_key, condition_value)
-            log.debug("\t\t%s, %s => %s", condition_key, condition_value, res)
+            if record:
+                start = time.time()
+                res = self.evaluate(pr, condition_key, condition_value)
+                evaluation.record(self.name, condition_key, condition_value,
+                                  res, time.time() - start)
+            else:
+                res = self.evaluate(pr, condition_key, condition_value)
 
             if not res:
                 return True
 
         log.info("Matched %s", pr.number)
+        if evaluation is not None:
+            evaluation.matched(self.name)
+        if self.write_repo is None or self.dry_run:
+            self.write_issue = self.issue
+        else:
+            self.write_issue = self.write_repo.get_issue(pr.number)
+
         # If we've made it this far, we pass ALL conditions
         for action in self.actions:
             self.execute(pr, action)
@@ -94,6 +545,39 @@ class PullRequestFilter(object):
         # As a result, all of the math in evaluate() works.
         return result, condition_value
 
+    def request_cost(self):
+        """Estimated API requests applying this filter to one PR makes,
+        assuming every condition passes, a single page of comments and one
+        matching label
+        """
+        # Fetching the issue
+        cost = 1
+        for (condition_key, condition_value) in self._condition_it():
+            cost += CONDITION_COST.get(condition_key.split('__', 1)[0], 0)
+        if self.actions and self.write_repo is not None:
+            # Fetching the issue again as the bot_user
+            cost += 1
+        for action in self.actions:
+            cost += ACTION_COST.get(action['action'], 0)
+        return cost
+
+    def time_thresholds(self, now):
+        """PR ages at which our relative created_at conditions flip, e.g.
+        'relative::192 hours ago' => 192 hours.
+        """
+        thresholds = []
+        calendar = parsedatetime.Calendar()
+        for (condition_key, condition_value) in self._condition_it():
+            if condition_key.split('__', 1)[0] != 'created_at':
+                continue
+            (date_type, date_string) = condition_value.split('::', 1)
+            if date_type != 'relative':
+                continue
+            compare_against, parsed_as = calendar.parseDT(date_string, now)
+            if compare_against < now:
+                thresholds.append(now - compare_against)
+        return thresholds
+
     def evaluate(self, pr, condition_key, condition_value):
         """Evaluate a condition like "title_contains" or "plus__ge".
 
@@ -113,9 +597,7 @@ class PullRequestFilter(object):
         result = func(pr, cv=condition_value)
 
         if condition_key == 'created_at':
-            log.debug("\t\tTime: %s %s", result, condition_value)
             result, condition_value = self._time_to_int(result, condition_value)
-            log.debug("\t\tTime: %s %s", result, condition_value)
 
         # There are two types of conditions, text and numeric.
         # Numeric conditions are only appropriate for the following types:
@@ -148,7 +630,7 @@ class PullRequestFilter(object):
         return cv in pr.title
 
     def check_milestone(self, pr, cv=None):
-        """condition_value == pr.milestone
+        """condition_value == title of pr.milestone
         """
         return pr.milestone == cv
 
@@ -161,24 +643,38 @@ class PullRequestFilter(object):
             return pr.state == cv
 
     def _find_in_comments(self, pr, regex):
-        """Search for hits to a regex in a list of comments
-        """
-        if getattr(pr, 'memo_comments', None) is None:
-            pr.memo_comments = list(self.issue.get_comments())
+        """Search for hits to a regex in the PR's comments.
 
-        for comment in pr.memo_comments:
-            # log.debug('%s, "%s" => %s', regex, comment.body, re.match(regex, comment.body))
+        Comments are streamed from the API rather than kept around; only
+        their votes are memoised (see _votes).
+        """
+        for comment in self.issue.get_comments():
             if re.findall(regex, comment.body, re.MULTILINE):
                 yield comment
 
-    def check_plus(self, pr, cv=None):
+    def _votes(self, pr):
+        """(login, VOTE_* flags) for every voting comment on the PR
+        """
+        if pr.votes is None:
+            votes = []
+            for comment in self.issue.get_comments():
+                vote = classify_vote(comment.body)
+                if vote:
+                    votes.append((comment.user.login, vote))
+            pr.votes = votes
+        return pr.votes
+
+    def _count_votes(self, pr, flag):
         count = 0
-        for plus1_comment in self._find_in_comments(pr, UPVOTE_REGEX):
-            if plus1_comment.user.login in self.committer_group:
+        for (login, vote) in self._votes(pr):
+            if vote & flag and login in self.committer_group:
                 count += 1
 
         return count
 
+    def check_plus(self, pr, cv=None):
+        return self._count_votes(pr, VOTE_UP)
+
     def check_has_tag(self, pr, cv=None):
         """Checks that at least one tag matches the regex provided in condition_value
         """
@@ -192,15 +688,10 @@ class PullRequestFilter(object):
         return False
 
     def check_minus(self, pr, cv=None):
-        count = 0
-        for minus1_comment in self._find_in_comments(pr, DOWNVOTE_REGEX):
-            if minus1_comment.user.login in self.committer_group:
-                count += 1
-
-        return count
+        return self._count_votes(pr, VOTE_DOWN)
 
     def check_to_branch(self, pr, cv=None):
-        return pr.base.ref == cv
+        return pr.base_ref == cv
 
     def check_created_at(self, pr, cv=None):
         """Due to condition_values with times, check_created_at simply returns pr.created_at
@@ -223,7 +714,7 @@ class PullRequestFilter(object):
         """Commenting action, generates a comment on the parent PR
         """
         comment_text = action['comment'].format(
-            author='@' + pr.user.login
+            author='@' + pr.user_login
             #TODO
             #merged_by=
         ).strip().replace('\n', ' ')
@@ -241,7 +732,7 @@ class PullRequestFilter(object):
             return
 
         # Create the comment
-        self.issue.create_comment(
+        self.write_issue.create_comment(
             comment_text
         )
 
@@ -249,13 +740,13 @@ class PullRequestFilter(object):
         """Assigns a pr's milestone to next_milestone
         """
         # Can only update milestone through associated PR issue.
-        self.issue.edit(milestone=self.next_milestone)
+        self.write_issue.edit(milestone=self.next_milestone)
 
     def execute_assign_tag(self, pr, action):
         """Tags a PR
         """
         tag_name = action['action_value']
-        self.issue.add_to_labels(tag_name)
+        self.write_issue.add_to_labels(tag_name)
 
     def execute_remove_tag(self, pr, action):
         """remove a tag from PR if it matches the regex
@@ -263,55 +754,316 @@ class PullRequestFilter(object):
         m = re.compile(action['action_value'])
         for label in self.issue.get_labels():
             if m.match(label.name):
-                self.issue.remove_from_labels(label.name)
+                self.write_issue.remove_from_labels(label.name)
+
+
+class PollScheduler(object):
+    """Decides when each PR should next be re-checked in daemon mode.
+
+    PRs with recent activity are polled individually (hot every
+    `hot_interval`, warm every `warm_interval` seconds), as are PRs about to
+    cross one of the filters' created_at thresholds. Everything else is cold
+    and only seen by the full sweep every `sweep_interval` seconds.
+
+    All intervals are stretched by `scale` whenever the projected hourly
+    cost would exceed `rate_share` of the rate limit. That includes
+    re-evaluating PRs, for the share of polls that led to one.
+    """
+
+    def __init__(self, thresholds=None, hot_interval=60, hot_window=86400,
+                 warm_interval=900, warm_window=604800, sweep_interval=21600,
+                 rate_share=0.5):
+        self.thresholds = [] if thresholds is None else thresholds
+        self.hot_interval = hot_interval
+        self.hot_window = hot_window
+        self.warm_interval = warm_interval
+        self.warm_window = warm_window
+        self.sweep_interval = sweep_interval
+        self.rate_share = rate_share
+        self.scale = 1.0
+        # PR number => (unscaled interval, next check, last seen)
+        self.schedule = {}
+        # Polls since the last rescale, and how many re-evaluated the PR
+        self.polls = 0
+        self.evaluations = 0
+        # Until we've seen any polls, assume they all do
+        self.evaluation_share = 1.0
+
+    def base_interval(self, pr, now):
+        """Unscaled polling interval for a PR, or None if it is cold
+        """
+        age = (now - pr.updated_at).total_seconds()
+        if age < self.hot_window:
+            interval = self.hot_interval
+        elif age < self.warm_window:
+            interval = self.warm_interval
+        else:
+            interval = self.sweep_interval
+
+        # Check again just after the PR crosses a time threshold
+        for threshold in self.thresholds:
+            until = (pr.created_at + threshold - now).total_seconds()
+            if 0 < until < interval:
+                interval = max(until + 1, self.hot_interval)
+
+        if interval >= self.sweep_interval:
+            return None
+        return interval
+
+    def observe(self, pr, now):
+        """(Re)schedule a PR after it has been seen at `now`
+        """
+        interval = self.base_interval(pr, now)
+        if interval is None:
+            self.schedule.pop(pr.number, None)
+        else:
+            self.schedule[pr.number] = (
+                interval,
+                now + datetime.timedelta(seconds=interval * self.scale),
+                now,
+            )
+
+    def polled(self, evaluated):
+        """Count a poll, and whether the PR was re-evaluated after it"""
+        self.polls += 1
+        if evaluated:
+            self.evaluations += 1
+
+    def crossed(self, pr, since, now):
+        """Whether the PR crossed a time threshold in (since, now]
+        """
+        for threshold in self.thresholds:
+            if since < pr.created_at + threshold <= now:
+                return True
+        return False
+
+    def due(self, now):
+        """PR numbers whose next check is at or before `now`
+        """
+        return [number for (number, (interval, when, seen)) in
+                self.schedule.items() if when <= now]
+
+    def next_due(self):
+        if not self.schedule:
+            return None
+        return min(when for (interval, when, seen) in self.schedule.values())
+
+    def rescale(self, listing_pages, rate_limit, pr_cost=0):
+        """Stretch all intervals so the projected hourly cost of sweeps plus
+        individual polls stays within rate_share of rate_limit. Polls that
+        re-evaluate their PR cost another `pr_cost` requests.
+        """
+        if self.polls:
+            self.evaluation_share = float(self.evaluations) / self.polls
+            self.polls = 0
+            self.evaluations = 0
+
+        poll_cost = 1 + self.evaluation_share * pr_cost
+        hourly = listing_pages * 3600.0 / self.sweep_interval
+        for (interval, when, seen) in self.schedule.values():
+            hourly += 3600.0 / interval * poll_cost
+
+        budget = self.rate_share * rate_limit
+        self.scale = max(1.0, hourly / budget)
+        if self.scale > 1.0:
+            log.warn("Polling would use %d requests/hour, slowing down by %.1fx", hourly, self.scale)
+
+        for (number, (interval, when, seen)) in self.schedule.items():
+            self.schedule[number] = (
+                interval,
+                seen + datetime.timedelta(seconds=interval * self.scale),
+                seen,
+            )
+
+
+class OutOfBudget(Exception):
+    """Raised when the RunPlanner won't allow any more requests"""
+
+
+class RunPlanner(object):
+    """Estimates the API cost of a run, and stops it before it makes more
+    than `max_requests` requests or leaves fewer than `reserve` of our
+    quota. Work left over is picked up by the next run from the checkpoint.
+
+    Per-PR costs are estimates, so a PR with many comments or labels can
+    take a run slightly past these limits.
+    """
+
+    def __init__(self, max_requests=None, reserve=0):
+        self.max_requests = max_requests
+        self.reserve = reserve
+        self.start_remaining = None
+
+    def start(self, remaining):
+        # Shared between repositories, the first one to start counts
+        if self.start_remaining is None:
+            self.start_remaining = remaining
+
+    def estimate(self, listing_pages, queued, pr_cost):
+        """Requests needed to list PRs and then process `queued` of them
+        """
+        return listing_pages + queued * pr_cost
+
+    def allow(self, remaining, cost):
+        """Whether we can afford `cost` more requests
+        """
+        if self.max_requests is not None:
+            spent = self.start_remaining - remaining
+            if spent + cost > self.max_requests:
+                return False
+        return remaining - cost >= self.reserve
+
+
+def repository_configs(config):
+    """The repository blocks from a config, with `defaults` filled in.
+
+    Accepts either a single `repository` or a list of `repositories`.
+    """
+    if 'repositories' in config:
+        entries = config['repositories']
+    else:
+        entries = [config['repository']]
+
+    repositories = []
+    for entry in entries:
+        repository = dict(config.get('defaults', {}))
+        repository.update(entry)
+        repositories.append(repository)
+    return repositories
+
+
+def load_bots(conf_path, dry_run=False):
+    """One MergerBot per configured repository"""
+    with open(conf_path, 'r') as handle:
+        config = yaml.load(handle)
+
+    if len(gh.clients) > 1:
+        writer_login = gh.writer.client().get_user().login
+        if writer_login != config['meta']['bot_user']:
+            log.warn("Writing as %s rather than bot_user %s, comments may be duplicated",
+                     writer_login, config['meta']['bot_user'])
+
+    decisions = None
+    if 'decision_log' in config['meta']:
+        decisions = DecisionLog(**config['meta']['decision_log'])
+
+    return [MergerBot(config, repository, dry_run=dry_run, decisions=decisions)
+            for repository in repository_configs(config)]
+
+
+def run_all(bots, func, workers=None):
+    """Call func(bot) for every bot concurrently, in a pool of `workers`
+    threads (one per bot by default). Returns the results in order, or
+    the exception for bots that raised.
+    """
+    def run_one(bot):
+        try:
+            return func(bot)
+        except Exception, e:
+            log.exception("[%s] Failed", bot.full_name)
+            return e
+
+    if len(bots) == 1:
+        return [run_one(bots[0])]
+
+    pool = ThreadPool(workers or len(bots))
+    try:
+        return pool.map(run_one, bots)
+    finally:
+        pool.close()
 
 
 class MergerBot(object):
 
-    def __init__(self, conf_path, dry_run=False):
+    def __init__(self, config, repository, dry_run=False, decisions=None):
         self.dry_run = dry_run
-        with open(conf_path, 'r') as handle:
-            self.config = yaml.load(handle)
+        self.config = config
+        self.decisions = decisions
 
         self.create_db(database_name=os.path.abspath(
             self.config['meta']['database_path']))
 
         self.timefmt = "%Y-%m-%dT%H:%M:%S.Z"
 
-        self.repo_owner = self.config['repository']['owner']
-        self.repo_name = self.config['repository']['name']
-        self.repo = gh.get_repo(self.repo_owner + '/' + self.repo_name)
+        self.repo_owner = repository['owner']
+        self.repo_name = repository['name']
+        self.full_name = self.repo_owner + '/' + self.repo_name
+        self.repo = gh.get_repo(self.full_name)
+        self.write_repo = gh.get_writer_repo(self.full_name)
 
         self.pr_filters = []
         self.next_milestone = [
             milestone for milestone in self.repo.get_milestones() if
-            milestone.title == self.config['repository']['next_milestone']][0]
+            milestone.title == repository['next_milestone']][0]
 
-        for rule in self.config['repository']['filters']:
+        for rule in repository['filters']:
             prf = PullRequestFilter(
                 name=rule['name'],
                 conditions=rule['conditions'],
                 actions=rule['actions'],
                 next_milestone=self.next_milestone,
                 repo=self.repo,
-                committer_group=self.config['repository']['pr_approvers'],
+                write_repo=self.write_repo,
+                committer_group=repository['pr_approvers'],
                 bot_user=self.config['meta']['bot_user'],
                 dry_run=self.dry_run,
             )
             self.pr_filters.append(prf)
 
     def create_db(self, database_name='cache.sqlite'):
-        """Create the database if it doesn't exist"""
-        self.conn = sqlite3.connect(database_name)
+        """Create the database if it doesn't exist.
+
+        Every repository's bot has its own connection to the same database,
+        and is only ever used by one thread at a time.
+        """
+        self.conn = sqlite3.connect(database_name, timeout=30,
+                                    check_same_thread=False)
         cursor = self.conn.cursor()
+        # PR ids are unique across repositories, repo is only there to
+        # tell them apart.
         cursor.execute(
             """
             CREATE TABLE IF NOT EXISTS pr_data(
                 pr_id INTEGER PRIMARY KEY,
+                updated_at TEXT,
+                repo TEXT
+            )
+            """
+        )
+        # Changed PRs still to be processed, so an interrupted run can pick
+        # up where it stopped
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS run_queue(
+                position INTEGER PRIMARY KEY AUTOINCREMENT,
+                pr_id INTEGER UNIQUE,
+                repo TEXT,
+                number INTEGER,
+                title TEXT,
+                state TEXT,
+                merged INTEGER,
+                base_ref TEXT,
+                milestone TEXT,
+                user_login TEXT,
+                created_at TEXT,
                 updated_at TEXT
             )
             """
         )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS run_state(
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+            """
+        )
+        # Databases from before multiple repositories were supported
+        for table in ('pr_data', 'run_queue'):
+            cursor.execute("""PRAGMA table_info(%s)""" % table)
+            if 'repo' not in [column[1] for column in cursor.fetchall()]:
+                cursor.execute("""ALTER TABLE %s ADD COLUMN repo TEXT""" % table)
+        self.conn.commit()
 
     def fetch_pr_from_db(self, id):
         """select PR from database cache by PR #"""
@@ -332,8 +1084,8 @@ class MergerBot(object):
         """Store the PR in the DB cache, along with the last-updated
         date"""
         cursor = self.conn.cursor()
-        cursor.execute("""INSERT INTO pr_data VALUES (?, ?)""",
-                       (str(id), updated_at.strftime(self.timefmt)))
+        cursor.execute("""INSERT INTO pr_data (pr_id, updated_at, repo) VALUES (?, ?, ?)""",
+                       (str(id), updated_at.strftime(self.timefmt), self.full_name))
         self.conn.commit()
 
     def update_pr(self, id, updated_at):
@@ -341,66 +1093,444 @@ class MergerBot(object):
         if self.dry_run:
             return
         cursor = self.conn.cursor()
-        cursor.execute("""UPDATE pr_data SET updated_at = ? where pr_id = ?""",
-                       (updated_at.strftime(self.timefmt), str(id)))
+        cursor.execute("""UPDATE pr_data SET updated_at = ?, repo = ? where pr_id = ?""",
+                       (updated_at.strftime(self.timefmt), self.full_name, str(id)))
+        self.conn.commit()
+
+    def cached_pr_count(self):
+        """Number of this repository's PRs in the database cache"""
+        cursor = self.conn.cursor()
+        cursor.execute("""SELECT COUNT(*) FROM pr_data WHERE repo = ?""", (self.full_name, ))
+        return cursor.fetchone()[0]
+
+    def get_state(self, key):
+        """Fetch a value for this repository from the run_state table"""
+        cursor = self.conn.cursor()
+        cursor.execute("""SELECT value FROM run_state WHERE key = ?""",
+                       (self.full_name + ':' + key, ))
+        row = cursor.fetchone()
+        return None if row is None else row[0]
+
+    def set_state(self, key, value):
+        """Store a value for this repository in the run_state table, or
+        remove it if None"""
+        key = self.full_name + ':' + key
+        cursor = self.conn.cursor()
+        if value is None:
+            cursor.execute("""DELETE FROM run_state WHERE key = ?""", (key, ))
+        else:
+            cursor.execute("""INSERT OR REPLACE INTO run_state VALUES (?, ?)""",
+                           (key, value))
+        self.conn.commit()
+
+    def enqueue_pr(self, pr):
+        """Add a changed PR to the checkpointed queue, replacing any older
+        entry for it"""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            """INSERT OR REPLACE INTO run_queue
+            (pr_id, repo, number, title, state, merged, base_ref, milestone,
+             user_login, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (pr.id, self.full_name, pr.number, pr.title, pr.state, int(pr.merged),
+             pr.base_ref, pr.milestone, pr.user_login,
+             pr.created_at.strftime(self.timefmt),
+             pr.updated_at.strftime(self.timefmt)))
+        self.conn.commit()
+
+    def queue_length(self):
+        """Number of this repository's PRs left in the checkpointed queue"""
+        cursor = self.conn.cursor()
+        cursor.execute("""SELECT COUNT(*) FROM run_queue WHERE repo = ?""", (self.full_name, ))
+        return cursor.fetchone()[0]
+
+    def queued_prs(self):
+        """Yield (position, PullRequestRecord) from the queue in order.
+
+        Rows are fetched one at a time as committing resets open cursors.
+        """
+        position = 0
+        while True:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                """SELECT position, pr_id, number, title, state, merged,
+                base_ref, milestone, user_login, created_at, updated_at
+                FROM run_queue WHERE repo = ? AND position > ?
+                ORDER BY position LIMIT 1""",
+                (self.full_name, position))
+            row = cursor.fetchone()
+            if row is None:
+                return
+
+            position = row[0]
+            yield position, PullRequestRecord(
+                id=row[1],
+                number=row[2],
+                title=row[3],
+                state=row[4],
+                merged=bool(row[5]),
+                base_ref=row[6],
+                milestone=row[7],
+                user_login=row[8],
+                created_at=datetime.datetime.strptime(row[9], self.timefmt),
+                updated_at=datetime.datetime.strptime(row[10], self.timefmt),
+            )
+
+    def dequeue_pr(self, position):
+        """Remove a processed PR from the queue"""
+        cursor = self.conn.cursor()
+        cursor.execute("""DELETE FROM run_queue WHERE position = ?""", (position, ))
         self.conn.commit()
 
-    def all_prs(self):
+    def pr_cost(self):
+        """Estimated API requests needed to process one PR"""
+        return sum(pr_filter.request_cost() for pr_filter in self.pr_filters)
+
+    def all_prs(self, planner=None, checkpoint=False):
         """List all open PRs in the repo.
 
         This... needs work. As it is it fetches EVERY PR, open and closed
         and that's a monotonically increasing number of API requests per
         run. Suboptimal.
-        """
-        log.info("Locating closed PRs")
-        results = self.repo.get_pulls(state='closed')
-        for i, result in enumerate(results):
-            yield result
 
-        log.info("Locating open PRs")
-        results = self.repo.get_pulls(state='open')
-        for result in results:
-            yield result
+        Pages are fetched one at a time, asking the planner (if given)
+        before each one. Raises OutOfBudget if it won't allow another.
 
-    def get_modified_prs(self):
-        """This will contain a list of all new/updated PRs to filter
+        With checkpoint, the next page to fetch is stored in run_state once
+        the previous one has been consumed, and the listing resumes from
+        there. PRs that move between the closed and open listings in the
+        meantime are picked up by the next full listing.
+        """
+        states = ['closed', 'open']
+        page = 0
+        if checkpoint and self.get_state('listing_page') is not None:
+            (state, page) = self.get_state('listing_page').split(':')
+            states = states[states.index(state):]
+            page = int(page)
+            log.info("[%s] Resuming the listing of %s PRs from page %s", self.full_name, state, page)
+
+        for state in states:
+            log.info("[%s] Locating %s PRs", self.full_name, state)
+            results = self.repo.get_pulls(state=state)
+            while True:
+                if checkpoint:
+                    self.set_state('listing_page', '%s:%d' % (state, page))
+                if planner is not None and not planner.allow(gh.rate_limiting[0], 1):
+                    raise OutOfBudget("Out of API budget while listing %s PRs" % state)
+                resources = results.get_page(page)
+                for result in resources:
+                    yield result
+                if len(resources) < PAGE_SIZE:
+                    break
+                page += 1
+            page = 0
+
+    def get_modified_prs(self, observe=None, planner=None, checkpoint=False):
+        """Yield all new/updated PRs to filter
+
+        If given, observe is called with every listed PR, changed or not.
+        The planner and checkpoint are passed on to all_prs.
         """
-        changed_prs = []
         # Loop across our GH results
-        for resource in self.all_prs():
+        for resource in self.all_prs(planner=planner, checkpoint=checkpoint):
+            if observe is not None:
+                observe(resource)
             # Fetch the PR's ID which we use as a key in our db.
             cached_pr = self.fetch_pr_from_db(resource.id)
-            # If it's new, cache it.
+            # If it's new, cache it once the caller has queued it, so it
+            # isn't lost if we're interrupted in between.
             if cached_pr is None:
+                yield PullRequestRecord.from_github(resource)
                 self.cache_pr(resource.id, resource.updated_at)
-                changed_prs.append(resource)
             else:
                 # compare updated_at times.
                 cached_pr_time = cached_pr[1]
                 if cached_pr_time != resource.updated_at:
                     log.debug('[%s] Cache says: %s last updated at %s', resource.number, cached_pr_time, resource.updated_at)
-                    changed_prs.append(resource)
-        return changed_prs
+                    yield PullRequestRecord.from_github(resource)
 
-    def run(self):
-        """Find modified PRs, apply the PR filter, and execute associated
+    def process_pr(self, changed):
+        """Apply every PR filter to a single PR, and execute associated
         actions"""
-        changed_prs = self.get_modified_prs()
-        log.info("Found %s PRs to examine", len(changed_prs))
-        for changed in changed_prs:
+        evaluation = None
+        if self.decisions is not None:
+            evaluation = self.decisions.evaluation(self.full_name, changed.number)
+        for pr_filter in self.pr_filters:
+            success = pr_filter.apply(changed, evaluation=evaluation)
+            if success and not self.dry_run:
+                # Otherwise we'll hit it again later
+                self.update_pr(changed.id, changed.updated_at)
+        # Votes are only needed while this PR is being evaluated
+        changed.votes = None
+
+    def pending_prs(self, planner=None, observe=None):
+        """Yield (position, PullRequestRecord) for each PR to process.
+
+        Changed PRs are listed into the run_queue table first, unless an
+        earlier run already finished listing and left PRs in the queue. If
+        an earlier run was interrupted while listing, the PRs it queued are
+        processed first, and the listing then resumes from the page it
+        stopped at. If observe is given the whole listing always happens,
+        as the caller needs to see every PR; PRs left over are then
+        processed along with the new ones. Raises OutOfBudget if the
+        planner runs out of budget while listing. Dry runs bypass the
+        queue, and yield None positions.
+        """
+        if self.dry_run:
+            for changed in self.get_modified_prs(observe=observe, planner=planner):
+                yield None, changed
+            return
+
+        listing = self.get_state('listing')
+        if listing == 'complete' and observe is None:
+            log.info("[%s] Resuming from checkpoint", self.full_name)
+        else:
+            if listing == 'started' and observe is None:
+                log.info("[%s] Processing %s PRs queued before the listing was interrupted",
+                         self.full_name, self.queue_length())
+                for pending in self.queued_prs():
+                    yield pending
+            else:
+                self.set_state('listing_page', None)
+            self.set_state('listing', 'started')
+            for changed in self.get_modified_prs(observe=observe, planner=planner,
+                                                 checkpoint=observe is None):
+                self.enqueue_pr(changed)
+            self.set_state('listing', 'complete')
+            self.set_state('listing_page', None)
+
+        log.info("[%s] Found %s PRs to examine", self.full_name, self.queue_length())
+        for pending in self.queued_prs():
+            yield pending
+
+        self.set_state('listing', None)
+
+    def plan(self, planner):
+        """Log the estimated API cost of a run before starting it"""
+        remaining = gh.rate_limiting[0]
+        pr_cost = self.pr_cost()
+        planner.start(remaining)
+        queued = self.queue_length()
+        if self.get_state('listing') == 'complete':
+            listing_pages = 0
+        else:
+            listing_pages = int(math.ceil((self.cached_pr_count() + 1) / float(PAGE_SIZE)))
+            if self.get_state('listing_page') is not None:
+                # Resuming the closed listing, whose first pages are done
+                (state, page) = self.get_state('listing_page').split(':')
+                if state == 'closed':
+                    listing_pages = max(1, listing_pages - int(page))
+        estimate = planner.estimate(listing_pages, queued, pr_cost)
+        # How many PRs changed isn't known until they're listed
+        log.info("[%s] Estimated cost: about %s requests (%s listing, %s queued PRs at %s each), "
+                 "plus %s per changed PR the listing finds, %s remaining",
+                 self.full_name, estimate, listing_pages, queued, pr_cost, pr_cost, remaining)
+
+    def run(self, planner=None, observe=None):
+        """Find modified PRs, apply the PR filter, and execute associated
+        actions.
+
+        Returns False if the run was cut short by the planner or the rate
+        limit, in which case the next run resumes from the checkpoint.
+        """
+        if planner is not None:
+            self.plan(planner)
+
+        pr_cost = self.pr_cost()
+        try:
+            for (position, changed) in self.pending_prs(planner=planner, observe=observe):
+                if planner is not None and not planner.allow(gh.rate_limiting[0], pr_cost):
+                    raise OutOfBudget("Out of API budget, stopping before %s" % changed.number)
+                self.process_pr(changed)
+                if position is not None:
+                    self.dequeue_pr(position)
+        except (RateLimitExceededException, OutOfBudget), e:
+            log.warn("[%s] Stopping early, the next run will resume from here", self.full_name)
+            log.warn(e)
+            return False
+        finally:
+            if self.decisions is not None:
+                self.decisions.flush()
+
+        return self.dry_run or self.get_state('listing') is None
+
+    def sweep(self, scheduler, now):
+        """Full pass over the listing: process changed PRs like run() does,
+        and let the scheduler see every PR so it can pick out hot ones"""
+        # A list so the closure can update it
+        listed = [0]
+
+        def observe(resource):
+            listed[0] += 1
+            scheduler.observe(resource, now)
+
+        self.run(observe=observe)
+        log.info("[%s] Polling %s PRs individually", self.full_name, len(scheduler.schedule))
+        scheduler.rescale(int(math.ceil(listed[0] / float(PAGE_SIZE))), gh.rate_limiting[1],
+                          pr_cost=self.pr_cost())
+
+    def fetch_pr_if_modified(self, number, etag=None, last_modified=None):
+        """Fetch a single PR, conditionally on the etag/last_modified of an
+        earlier response if we have them.
+
+        Returns (PullRequestRecord, etag, last_modified), or None if the PR
+        is unchanged. 304s don't count against the rate limit.
+        """
+        if etag is None and last_modified is None:
+            pr = self.repo.get_pull(number)
+        else:
+            headers = {}
+            if etag is not None:
+                headers[Consts.RES_ETAG] = etag
+            if last_modified is not None:
+                headers[Consts.RES_LAST_MODIFIED] = last_modified
+            # An empty PR carrying only the validators, which update()
+            # sends along and fills in on a 200
+            pr = PullRequest(self.repo._requester, headers,
+                             {'url': '%s/pulls/%s' % (self.repo.url, number)},
+                             completed=False)
+            if not pr.update():
+                return None
+
+        return PullRequestRecord.from_github(pr), pr.etag, pr.last_modified
+
+    def poll_pr(self, scheduler, handles, number, now):
+        """Re-check a single scheduled PR with a conditional request"""
+        since = scheduler.schedule[number][2]
+        (etag, last_modified, record) = handles.get(number, (None, None, None))
+        fetched = self.fetch_pr_if_modified(number, etag, last_modified)
+        changed = fetched is not None
+        if changed:
+            (record, etag, last_modified) = fetched
+            cached_pr = self.fetch_pr_from_db(record.id)
+            changed = cached_pr is None or cached_pr[1] != record.updated_at
+
+        evaluate = changed or scheduler.crossed(record, since, now)
+        if evaluate:
+            self.process_pr(record)
+        scheduler.polled(evaluate)
+
+        scheduler.observe(record, now)
+        if number in scheduler.schedule:
+            handles[number] = (etag, last_modified, record)
+        else:
+            handles.pop(number, None)
+
+    def throttle(self, rate_share):
+        """Sleep until the rate limit resets once the whole pool has used
+        rate_share of it"""
+        remaining, limit = gh.rate_limiting
+        if remaining < limit * (1 - rate_share):
+            wait = max(0, gh.rate_limiting_resettime - time.time())
+            log.warn("Used our share of the rate limit (%s/%s left), sleeping %ds", remaining, limit, wait)
+            time.sleep(wait)
+
+    def daemon(self, repositories=1):
+        """Run forever, re-checking each PR as often as its activity and
+        upcoming time thresholds warrant.
+
+        When the daemons of several `repositories` share the client pool,
+        each plans its polling for an equal part of rate_share, while the
+        throttle applies rate_share to all of them together.
+        """
+        now = datetime.datetime.utcnow()
+        thresholds = []
+        for pr_filter in self.pr_filters:
+            thresholds.extend(pr_filter.time_thresholds(now))
+        options = dict(self.config['meta'].get('daemon', {}))
+        rate_share = options.pop('rate_share', 0.5)
+        scheduler = PollScheduler(
+            thresholds=thresholds,
+            rate_share=rate_share / repositories,
+            **options
+        )
 
-            log.debug("Evaluating %s", changed.number)
-            for pr_filter in self.pr_filters:
-                success = pr_filter.apply(changed)
-                if success and not self.dry_run:
-                    # Otherwise we'll hit it again later
-                    self.update_pr(changed.id, changed.updated_at)
+        # PR number => (etag, last_modified, PullRequestRecord) for
+        # scheduled PRs only, so we can send conditional requests
+        handles = {}
+        next_sweep = now
+        # Sweeps failed in a row
+        failures = 0
+        while True:
+            now = datetime.datetime.utcnow()
+            if now >= next_sweep:
+                try:
+                    self.sweep(scheduler, now)
+                except Exception, e:
+                    failures += 1
+                    # Back off, but never for longer than a regular sweep
+                    wait = min(scheduler.sweep_interval, 60 * 2 ** failures)
+                    log.warn("[%s] Sweep failed, retrying in %ds", self.full_name, wait)
+                    log.warn(e)
+                    next_sweep = now + datetime.timedelta(seconds=wait)
+                else:
+                    failures = 0
+                    gh.report()
+                    next_sweep = now + datetime.timedelta(
+                        seconds=scheduler.sweep_interval * scheduler.scale)
+                    for number in list(handles):
+                        if number not in scheduler.schedule:
+                            del handles[number]
+
+            for number in scheduler.due(now):
+                try:
+                    self.poll_pr(scheduler, handles, number, now)
+                except Exception, e:
+                    log.warn("[%s] Could not poll %s", self.full_name, number)
+                    log.warn(e)
+                    # Leave it to the next sweep
+                    scheduler.schedule.pop(number, None)
+                    handles.pop(number, None)
+
+            if self.decisions is not None:
+                self.decisions.flush()
+            self.throttle(rate_share)
+            wake = min(next_sweep, scheduler.next_due() or next_sweep)
+            time.sleep(max(1, (wake - datetime.datetime.utcnow()).total_seconds()))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='P4 bot')
     parser.add_argument('--dry-run', dest='dry_run', action='store_true')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running, polling PRs adaptively')
+    parser.add_argument('--max-requests', dest='max_requests', type=int,
+                        help='Stop after roughly this many API requests')
+    parser.add_argument('--reserve', type=int, default=0,
+                        help='Stop before leaving fewer than this many API requests')
+    parser.add_argument('--explain', metavar='PR#',
+                        help='Explain why a PR (e.g. 1234 or galaxyproject/galaxy#1234) '
+                        'did or did not match each filter, from the decision log')
     args = parser.parse_args()
 
-    bot = MergerBot('conf.yaml', **vars(args))
-    bot.run()
+    if args.explain:
+        (repo, _, number) = args.explain.rpartition('#')
+        if not number.isdigit():
+            parser.error("--explain takes a PR number, e.g. 1234 or galaxyproject/galaxy#1234")
+        with open('conf.yaml', 'r') as handle:
+            config = yaml.load(handle)
+        if 'decision_log' not in config['meta']:
+            parser.error("No decision_log is configured under meta in conf.yaml")
+        for line in explain(config['meta']['decision_log']['path'], int(number),
+                            repo=repo or None):
+            print(line)
+        raise SystemExit()
+
+    log.warn("GH API RATE LIMIT: %s/%s" % gh.rate_limiting)
+    bots = load_bots('conf.yaml', dry_run=args.dry_run)
+    workers = bots[0].config['meta'].get('workers', None)
+    if args.daemon:
+        # Daemons never return, so every repository needs its own thread
+        if workers is not None and workers < len(bots):
+            log.warn("Ignoring meta.workers, the daemon needs one per repository")
+        results = run_all(bots, lambda bot: bot.daemon(repositories=len(bots)),
+                          workers=len(bots))
+    else:
+        # Shared, so the limits apply to all repositories together
+        planner = RunPlanner(max_requests=args.max_requests,
+                             reserve=args.reserve)
+        results = run_all(bots, lambda bot: bot.run(planner=planner), workers=workers)
+        gh.report()
+
+    if any(isinstance(result, Exception) for result in results):
+        sys.exit(1)
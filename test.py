@@ -1,7 +1,17 @@
 # -*- coding: utf-8 -*-
 import unittest
-from process import PullRequestFilter, UPVOTE_REGEX, DOWNVOTE_REGEX
+import process
+from process import PullRequestFilter, PullRequestRecord, PollScheduler, \
+    MergerBot, RunPlanner, OutOfBudget, ClientPool, PooledClient, UPVOTE_REGEX, VOTE_UP, \
+    VOTE_DOWN, DecisionLog, classify_vote, explain, repository_configs, run_all
+from github import BadCredentialsException, RateLimitExceededException
 import datetime
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
 import parsedatetime
 from attrdict import AttrDict
 
@@ -93,9 +103,7 @@ class TestPullRequestFilter(unittest.TestCase):
     def test_check_to_branch(self):
         prf = PullRequestFilter("test_filter", [], [])
         fakepr = AttrDict({
-            'base': {
-                'ref': 'dev'
-            }
+            'base_ref': 'dev'
         })
 
         self.assertTrue(
@@ -214,6 +222,37 @@ You have my :+1:, but I'd like a second pair of eyes merging this.""", 'expect':
                 msg="body: '%s' did not produce the expected result." % x[0]['body']
             )
 
+    def test_classify_vote(self):
+        self.assertEquals(classify_vote('+1'), VOTE_UP)
+        self.assertEquals(classify_vote('asdf\n:-1:\nasdf'), VOTE_DOWN)
+        self.assertEquals(classify_vote(':+1: and :-1:'), VOTE_UP | VOTE_DOWN)
+        self.assertEquals(classify_vote('asdf +1 asdf'), 0)
+
+    def test_votes_are_memoised(self):
+        prf = PullRequestFilter("test_filter", [], [], committer_group=['erasche'])
+        calls = []
+
+        def get_comments():
+            calls.append(1)
+            return [
+                AttrDict({'body': ':+1:', 'user': {'login': 'erasche'}}),
+                AttrDict({'body': 'looks good', 'user': {'login': 'erasche'}}),
+                AttrDict({'body': '-1', 'user': {'login': 'erasche'}}),
+            ]
+
+        prf.issue = AttrDict({
+            'get_comments': get_comments
+        })
+        tmppr = AttrDict({
+            'votes': None
+        })
+
+        self.assertEquals(prf.check_plus(tmppr), 1)
+        self.assertEquals(prf.check_minus(tmppr), 1)
+        self.assertEquals(len(calls), 1)
+        # Non-voting comments aren't kept
+        self.assertEquals(list(tmppr.votes), [('erasche', VOTE_UP), ('erasche', VOTE_DOWN)])
+
     def test_check_minus_member(self):
         prf = PullRequestFilter("test_filter", [], [], committer_group=['erasche'])
         test_cases = [
@@ -227,9 +266,12 @@ You have my :+1:, but I'd like a second pair of eyes merging this.""", 'expect':
         ]
 
         for case in test_cases:
+            prf.issue = AttrDict({
+                'get_comments': lambda: [AttrDict(case)]
+            })
             tmppr = AttrDict({
                 'state': 'open',
-                'memo_comments': [case]
+                'votes': None
             })
 
             self.assertEquals(
@@ -253,9 +295,12 @@ You have my :+1:, but I'd like a second pair of eyes merging this.""", 'expect':
         ]
 
         for case in test_cases:
+            prf.issue = AttrDict({
+                'get_comments': lambda: [AttrDict(case)]
+            })
             tmppr = AttrDict({
                 'state': 'open',
-                'memo_comments': [case]
+                'votes': None
             })
 
             self.assertEquals(
@@ -282,9 +327,12 @@ You have my :+1:, but I'd like a second pair of eyes merging this.""", 'expect':
         ]
 
         for case in test_cases:
+            prf.issue = AttrDict({
+                'get_comments': lambda: [AttrDict(case)]
+            })
             tmppr = AttrDict({
                 'state': 'open',
-                'memo_comments': [case]
+                'votes': None
             })
 
             self.assertEquals(
@@ -308,9 +356,12 @@ You have my :+1:, but I'd like a second pair of eyes merging this.""", 'expect':
         ]
 
         for case in test_cases:
+            prf.issue = AttrDict({
+                'get_comments': lambda: [AttrDict(case)]
+            })
             tmppr = AttrDict({
                 'state': 'open',
-                'memo_comments': [case]
+                'votes': None
             })
 
             self.assertEquals(
@@ -338,9 +389,7 @@ You have my :+1:, but I'd like a second pair of eyes merging this.""", 'expect':
         fakepr = AttrDict({
             u'title': u'[PROCEDURES] Testing…',
             u'state': u'open',
-            u'base': {
-                u'ref': u'dev'
-            },
+            u'base_ref': u'dev',
             u'created_at': self._get_dt_from_relative("1 day ago")
         })
 
@@ -370,3 +419,744 @@ You have my :+1:, but I'd like a second pair of eyes merging this.""", 'expect':
                 ('created_at__ge', 'relative::2 days ago'),
             ])
         )
+
+
+class TestPullRequestRecord(unittest.TestCase):
+
+    def test_from_github(self):
+        created = datetime.datetime(2016, 1, 1)
+        fakepr = AttrDict({
+            'number': 12,
+            'id': 3456,
+            'title': u'[PROCEDURES] Testing…',
+            'state': 'closed',
+            'merged_at': datetime.datetime(2016, 1, 3),
+            'base': {'ref': 'dev'},
+            'milestone': {'title': '16.04'},
+            'user': {'login': 'erasche'},
+            'created_at': created,
+            'updated_at': created,
+        })
+
+        record = PullRequestRecord.from_github(fakepr)
+        self.assertEquals(record.number, 12)
+        self.assertEquals(record.id, 3456)
+        self.assertTrue(record.merged)
+        self.assertEquals(record.base_ref, 'dev')
+        self.assertEquals(record.milestone, '16.04')
+        self.assertEquals(record.user_login, 'erasche')
+        self.assertTrue(record.votes is None)
+        self.assertFalse(hasattr(record, '__dict__'))
+
+        fakepr.merged_at = None
+        fakepr.milestone = None
+        record = PullRequestRecord.from_github(fakepr)
+        self.assertFalse(record.merged)
+        self.assertTrue(record.milestone is None)
+
+
+class TestPollScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.now = datetime.datetime(2016, 3, 1, 12, 0, 0)
+
+    def _pr(self, number, created_ago, updated_ago):
+        return AttrDict({
+            'number': number,
+            'created_at': self.now - created_ago,
+            'updated_at': self.now - updated_ago,
+        })
+
+    def test_time_thresholds(self):
+        prf = PullRequestFilter(
+            "test_filter",
+            [
+                {'created_at__lt': 'relative::192 hours ago'},
+                {'created_at__ge': 'precise::2016-01-01'},
+                {'state': 'open'},
+            ],
+            []
+        )
+        self.assertEquals(
+            prf.time_thresholds(self.now),
+            [datetime.timedelta(hours=192)]
+        )
+
+    def test_tiers(self):
+        scheduler = PollScheduler()
+        day = datetime.timedelta(days=1)
+        hot = self._pr(1, 3 * day, datetime.timedelta(minutes=5))
+        warm = self._pr(2, 30 * day, 3 * day)
+        cold = self._pr(3, 300 * day, 30 * day)
+
+        self.assertEquals(scheduler.base_interval(hot, self.now), 60)
+        self.assertEquals(scheduler.base_interval(warm, self.now), 900)
+        self.assertTrue(scheduler.base_interval(cold, self.now) is None)
+
+        for pr in (hot, warm, cold):
+            scheduler.observe(pr, self.now)
+        self.assertEquals(sorted(scheduler.schedule), [1, 2])
+        self.assertEquals(scheduler.due(self.now), [])
+        self.assertEquals(
+            scheduler.due(self.now + datetime.timedelta(minutes=1)), [1])
+
+    def test_upcoming_threshold(self):
+        scheduler = PollScheduler(thresholds=[datetime.timedelta(hours=192)])
+        # Stale, but crosses the threshold in two hours
+        pr = self._pr(1, datetime.timedelta(hours=190), datetime.timedelta(days=7, hours=1))
+        self.assertEquals(scheduler.base_interval(pr, self.now), 2 * 3600 + 1)
+
+        later = self.now + datetime.timedelta(hours=3)
+        self.assertTrue(scheduler.crossed(pr, self.now, later))
+        self.assertFalse(scheduler.crossed(pr, later, later + datetime.timedelta(hours=1)))
+
+    def test_rescale(self):
+        scheduler = PollScheduler(hot_interval=60, sweep_interval=3600, rate_share=0.5)
+        for number in range(100):
+            scheduler.observe(self._pr(number, datetime.timedelta(days=1), datetime.timedelta(0)), self.now)
+
+        # 100 PRs polled every minute is 6000/hour, plus 10 pages/hour
+        scheduler.rescale(10, 5000)
+        self.assertAlmostEquals(scheduler.scale, 6010 / 2500.0)
+        self.assertEquals(scheduler.due(self.now + datetime.timedelta(minutes=1)), [])
+
+        scheduler.rescale(10, 50000)
+        self.assertEquals(scheduler.scale, 1.0)
+
+    def test_rescale_evaluations(self):
+        scheduler = PollScheduler(hot_interval=60, sweep_interval=3600, rate_share=0.5)
+        for number in range(10):
+            scheduler.observe(self._pr(number, datetime.timedelta(days=1), datetime.timedelta(0)), self.now)
+
+        # Until polls have been seen, each is assumed to re-evaluate its PR
+        scheduler.rescale(0, 5000, pr_cost=4)
+        self.assertAlmostEquals(scheduler.scale, 600 * 5 / 2500.0)
+
+        # One in four polls re-evaluated its PR
+        for number in range(8):
+            scheduler.polled(number % 4 == 0)
+        scheduler.rescale(0, 5000, pr_cost=4)
+        self.assertAlmostEquals(scheduler.scale, 1.0)
+        scheduler.rescale(0, 1000, pr_cost=4)
+        self.assertAlmostEquals(scheduler.scale, 600 * 2 / 500.0)
+
+
+class StubRequester(object):
+    """Answers every request with the given status and PR"""
+
+    def __init__(self, status, data=None):
+        self.status = status
+        self.data = data
+        self.headers = []
+
+    def requestJson(self, verb, url, headers=None):
+        self.headers.append(headers)
+        output = None if self.data is None else json.dumps(self.data)
+        return self.status, {'etag': 'W/"2"'}, output
+
+    def _Requester__check(self, status, headers, output):
+        return headers, json.loads(output)
+
+
+def stub_bot(full_name='galaxyproject/galaxy', database_name=':memory:'):
+    """A MergerBot without running __init__, which talks to GitHub"""
+    bot = MergerBot.__new__(MergerBot)
+    bot.dry_run = False
+    bot.timefmt = "%Y-%m-%dT%H:%M:%S.Z"
+    bot.full_name = full_name
+    bot.pr_filters = []
+    bot.decisions = None
+    bot.create_db(database_name=database_name)
+    return bot
+
+
+def stub_gh(test):
+    """Replace process.gh with a stub for the rest of the test, so the rate
+    limit isn't asked from GitHub"""
+    gh = process.gh
+    process.gh = ClientPool([PooledClient(
+        'stub', lambda: ({}, None), factory=lambda: StubGithub(5000))])
+    test.addCleanup(setattr, process, 'gh', gh)
+
+
+class TestPollPr(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = stub_bot()
+        self.now = datetime.datetime(2016, 3, 1, 12, 0, 0)
+        self.data = {
+            'url': 'https://api.github.com/repos/galaxyproject/galaxy/pulls/12',
+            'number': 12,
+            'id': 1012,
+            'title': 'Testing',
+            'state': 'open',
+            'merged_at': None,
+            'base': {'ref': 'dev'},
+            'milestone': None,
+            'user': {'login': 'erasche'},
+            'created_at': '2016-02-01T00:00:00Z',
+            'updated_at': '2016-03-01T11:59:00Z',
+        }
+
+    def _repo(self, requester):
+        class Repository(object):
+            _requester = requester
+            url = 'https://api.github.com/repos/galaxyproject/galaxy'
+        return Repository()
+
+    def test_conditional_fetch(self):
+        requester = StubRequester(304)
+        self.bot.repo = self._repo(requester)
+        self.assertTrue(self.bot.fetch_pr_if_modified(12, 'W/"1"') is None)
+        self.assertEquals(requester.headers, [{'If-None-Match': 'W/"1"'}])
+
+        self.bot.repo = self._repo(StubRequester(200, self.data))
+        (record, etag, last_modified) = self.bot.fetch_pr_if_modified(12, 'W/"1"')
+        self.assertEquals(record.number, 12)
+        self.assertEquals(record.base_ref, 'dev')
+        self.assertEquals(etag, 'W/"2"')
+
+    def test_handles_are_compact(self):
+        scheduler = PollScheduler()
+        record = PullRequestRecord(
+            number=12, id=1012, title='Testing', state='open', merged=False,
+            base_ref='dev', milestone=None, user_login='erasche',
+            created_at=datetime.datetime(2016, 2, 1),
+            updated_at=self.now - datetime.timedelta(minutes=1))
+        scheduler.observe(record, self.now)
+        self.bot.cache_pr(record.id, record.updated_at)
+
+        processed = []
+        self.bot.process_pr = lambda pr: processed.append(pr.number)
+        self.bot.fetch_pr_if_modified = lambda number, etag, last_modified: \
+            (record, 'W/"1"', None) if etag is None else None
+
+        handles = {}
+        later = self.now + datetime.timedelta(minutes=2)
+        self.bot.poll_pr(scheduler, handles, 12, later)
+        self.assertEquals(handles, {12: ('W/"1"', None, record)})
+        # Unchanged since cached, and unchanged since the last poll
+        self.bot.poll_pr(scheduler, handles, 12, later + datetime.timedelta(minutes=2))
+        self.assertEquals(processed, [])
+        self.assertEquals(handles[12][0], 'W/"1"')
+
+    def test_daemon_splits_rate_share(self):
+        class Swept(BaseException):
+            pass
+
+        def sweep(scheduler, now):
+            raise Swept(scheduler)
+
+        self.bot.config = {'meta': {'daemon': {'rate_share': 0.6, 'hot_interval': 30}}}
+        self.bot.sweep = sweep
+        try:
+            self.bot.daemon(repositories=3)
+        except Swept, e:
+            scheduler = e.args[0]
+        self.assertAlmostEquals(scheduler.rate_share, 0.2)
+        self.assertEquals(scheduler.hot_interval, 30)
+
+    def test_daemon_survives_failed_sweep(self):
+        class Slept(BaseException):
+            pass
+
+        def sweep(scheduler, now):
+            sweeps.append(now)
+            raise IOError("502 Bad Gateway")
+
+        def sleep(seconds):
+            raise Slept(seconds)
+
+        sweeps = []
+        self.bot.config = {'meta': {}}
+        self.bot.sweep = sweep
+        stub_gh(self)
+        self.addCleanup(setattr, time, 'sleep', time.sleep)
+        time.sleep = sleep
+        try:
+            self.bot.daemon()
+        except Slept, e:
+            seconds = e.args[0]
+        # Retried after a back off rather than giving up
+        self.assertEquals(len(sweeps), 1)
+        self.assertTrue(110 < seconds <= 120)
+
+
+class TestRunPlanner(unittest.TestCase):
+
+    def test_request_cost(self):
+        prf = PullRequestFilter(
+            "test_filter",
+            [
+                {'state': 'open'},
+                {'has_tag__not': 'triage'},
+                {'plus__ge': 5},
+            ],
+            [{'action': 'comment', 'comment': 'hi'}]
+        )
+        # issue + has_tag + comments + comment dedup/create
+        self.assertEquals(prf.request_cost(), 1 + 2 + 1 + 2)
+
+    def test_max_requests(self):
+        planner = RunPlanner(max_requests=100)
+        planner.start(5000)
+        self.assertTrue(planner.allow(4950, 50))
+        self.assertFalse(planner.allow(4950, 51))
+
+    def test_reserve(self):
+        planner = RunPlanner(reserve=1000)
+        planner.start(5000)
+        self.assertTrue(planner.allow(1010, 10))
+        self.assertFalse(planner.allow(1010, 11))
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = stub_bot()
+
+    def _pr(self, number, id=None):
+        created = datetime.datetime(2016, 1, number)
+        return AttrDict({
+            'number': number,
+            'id': 1000 + number if id is None else id,
+            'title': 'PR %s' % number,
+            'state': 'open',
+            'merged_at': None,
+            'base': {'ref': 'dev'},
+            'milestone': None,
+            'user': {'login': 'erasche'},
+            'created_at': created,
+            'updated_at': created,
+        })
+
+    def test_resume(self):
+        self.bot.all_prs = lambda planner=None, checkpoint=False: iter([self._pr(1), self._pr(2), self._pr(3)])
+        processed = []
+
+        def process_pr(pr):
+            if pr.number == 2 and 2 not in processed:
+                processed.append(2)
+                raise RateLimitExceededException(403, 'rate limited')
+            processed.append(pr.number)
+
+        self.bot.process_pr = process_pr
+        self.assertFalse(self.bot.run())
+        self.assertEquals(processed, [1, 2])
+        self.assertEquals(self.bot.queue_length(), 2)
+
+        # The listing isn't repeated, and we carry on from PR 2
+        def all_prs(planner=None, checkpoint=False):
+            raise Exception("Should have resumed from the checkpoint")
+
+        self.bot.all_prs = all_prs
+        self.assertTrue(self.bot.run())
+        self.assertEquals(processed, [1, 2, 2, 3])
+        self.assertEquals(self.bot.queue_length(), 0)
+        self.assertEquals(self.bot.cached_pr_count(), 3)
+
+    def test_rate_limited_in_filter(self):
+        self.bot.all_prs = lambda planner=None, checkpoint=False: iter([self._pr(1), self._pr(2), self._pr(3)])
+        issues = []
+
+        def get_issue(number):
+            if not issues:
+                raise RateLimitExceededException(403, 'rate limited')
+            issues.append(number)
+
+        self.bot.pr_filters = [PullRequestFilter(
+            "test_filter", [], [], repo=AttrDict({'get_issue': get_issue}))]
+        self.assertFalse(self.bot.run())
+        self.assertEquals(self.bot.queue_length(), 3)
+
+        # Once the limit has reset, every PR is still evaluated
+        issues.append(None)
+        self.bot.all_prs = lambda planner=None, checkpoint=False: iter([])
+        self.assertTrue(self.bot.run())
+        self.assertEquals(issues, [None, 1, 2, 3])
+        self.assertEquals(self.bot.queue_length(), 0)
+
+    def test_observe_lists_despite_checkpoint(self):
+        # Left over by an earlier, interrupted run
+        self.bot.enqueue_pr(PullRequestRecord.from_github(self._pr(1)))
+        self.bot.cache_pr(1001, self._pr(1).updated_at)
+        self.bot.set_state('listing', 'complete')
+
+        self.bot.all_prs = lambda planner=None, checkpoint=False: iter([self._pr(1), self._pr(2)])
+        processed = []
+        observed = []
+        self.bot.process_pr = lambda pr: processed.append(pr.number)
+        self.assertTrue(self.bot.run(observe=lambda pr: observed.append(pr.number)))
+        self.assertEquals(observed, [1, 2])
+        self.assertEquals(processed, [1, 2])
+        self.assertEquals(self.bot.queue_length(), 0)
+
+    def test_listing_checks_budget_per_page(self):
+        self.bot.repo = AttrDict({'get_pulls': lambda state: listings[state]})
+        stub_gh(self)
+
+        # Two full pages of closed PRs, the partial one is the last
+        listings = {'closed': StubPulls(60), 'open': StubPulls(10)}
+        self.assertEquals(len(list(self.bot.all_prs(planner=StubPlanner(4)))), 70)
+        self.assertEquals([listings['closed'].pages, listings['open'].pages], [[0, 1, 2], [0]])
+
+        listings = {'closed': StubPulls(60), 'open': StubPulls(10)}
+        listed = []
+        try:
+            for pr in self.bot.all_prs(planner=StubPlanner(2)):
+                listed.append(pr)
+        except OutOfBudget:
+            pass
+        else:
+            self.fail("Listing should have run out of budget")
+        self.assertEquals(len(listed), 60)
+        self.assertEquals(listings['closed'].pages, [0, 1])
+
+    def test_budget_smaller_than_listing(self):
+        listings = {
+            'closed': StubPulls(90, lambda index: self._pr(index % 30 + 1, id=index)),
+            'open': StubPulls(10, lambda index: self._pr(index + 1, id=100 + index)),
+        }
+        self.bot.repo = AttrDict({'get_pulls': lambda state: listings[state]})
+        stub_gh(self)
+        processed = []
+        self.bot.process_pr = lambda pr: processed.append(pr.id)
+
+        # Two of the four closed pages fit, the last one being empty
+        self.assertFalse(self.bot.run(planner=StubPlanner(2)))
+        self.assertEquals(processed, [])
+        self.assertEquals(self.bot.queue_length(), 60)
+        self.assertEquals(self.bot.get_state('listing_page'), 'closed:2')
+
+        # The queued PRs go first, then the listing carries on where it
+        # stopped
+        self.assertFalse(self.bot.run(planner=StubPlanner(2)))
+        self.assertEquals(processed, range(60))
+        self.assertEquals(listings['closed'].pages, [0, 1, 2, 3])
+        self.assertEquals(self.bot.queue_length(), 30)
+        self.assertEquals(self.bot.get_state('listing_page'), 'open:0')
+
+        self.assertTrue(self.bot.run(planner=StubPlanner(2)))
+        self.assertEquals(processed, range(60) + range(60, 90) + range(100, 110))
+        self.assertEquals(listings['open'].pages, [0])
+        self.assertTrue(self.bot.get_state('listing_page') is None)
+        self.assertEquals(self.bot.queue_length(), 0)
+
+    def test_namespaced(self):
+        database = tempfile.NamedTemporaryFile(suffix='.sqlite')
+        galaxy = stub_bot('galaxyproject/galaxy', database.name)
+        planemo = stub_bot('galaxyproject/planemo', database.name)
+
+        galaxy.enqueue_pr(PullRequestRecord.from_github(self._pr(1)))
+        galaxy.set_state('listing', 'complete')
+        self.assertEquals(galaxy.queue_length(), 1)
+        self.assertEquals(planemo.queue_length(), 0)
+        self.assertTrue(planemo.get_state('listing') is None)
+
+        planemo.all_prs = lambda planner=None, checkpoint=False: iter([self._pr(2)])
+        planemo.process_pr = lambda pr: None
+        galaxy.process_pr = lambda pr: None
+        self.assertEquals(run_all([galaxy, planemo], lambda bot: bot.run()), [True, True])
+        self.assertEquals(galaxy.cached_pr_count(), 0)
+        self.assertEquals(planemo.cached_pr_count(), 1)
+
+    def test_run_all_failed(self):
+        galaxy = stub_bot('galaxyproject/galaxy')
+        planemo = stub_bot('galaxyproject/planemo')
+
+        def all_prs(planner=None, checkpoint=False):
+            raise IOError("502 Bad Gateway")
+
+        galaxy.all_prs = all_prs
+        planemo.all_prs = lambda planner=None, checkpoint=False: iter([])
+        (failed, done) = run_all([galaxy, planemo], lambda bot: bot.run())
+        # Told apart from a run that was cut short
+        self.assertTrue(isinstance(failed, IOError))
+        self.assertEquals(done, True)
+
+    def test_migrates_legacy_database(self):
+        database = tempfile.NamedTemporaryFile(suffix='.sqlite')
+        conn = sqlite3.connect(database.name)
+        conn.execute("""CREATE TABLE pr_data(pr_id INTEGER PRIMARY KEY, updated_at TEXT)""")
+        conn.execute("""INSERT INTO pr_data VALUES (1001, '2016-01-01T00:00:00.Z')""")
+        conn.commit()
+        conn.close()
+
+        bot = stub_bot('galaxyproject/galaxy', database.name)
+        # Still found by id, and claimed by the repository once updated
+        self.assertEquals(bot.fetch_pr_from_db(1001)[0], 1001)
+        self.assertEquals(bot.cached_pr_count(), 0)
+        bot.update_pr(1001, datetime.datetime(2016, 1, 2))
+        self.assertEquals(bot.cached_pr_count(), 1)
+
+
+class StubPulls(object):
+    """A listing of `count` PRs, built by `pr` from their index"""
+
+    def __init__(self, count, pr=None):
+        self.count = count
+        self.pr = (lambda number: number) if pr is None else pr
+        self.pages = []
+
+    def get_page(self, page):
+        self.pages.append(page)
+        return [self.pr(number) for number in
+                range(self.count)[page * 30:(page + 1) * 30]]
+
+
+class StubPlanner(RunPlanner):
+    """Allows `requests` requests, regardless of the rate limit"""
+
+    def __init__(self, requests):
+        RunPlanner.__init__(self)
+        self.requests = requests
+
+    def allow(self, remaining, cost):
+        self.requests -= cost
+        return self.requests >= 0
+
+
+class StubGithub(object):
+    """Simulates the rate limit of a single token"""
+
+    def __init__(self, remaining, limit=5000, resettime=None, error=None):
+        self.error = error
+        self.remaining = remaining
+        self.limit = limit
+        self.rate_limiting_resettime = time.time() + 3600 if resettime is None else resettime
+        self.calls = 0
+        self.labels = []
+
+    @property
+    def rate_limiting(self):
+        if self.error is not None:
+            raise self.error
+        return self.remaining, self.limit
+
+    def spend(self):
+        if self.remaining == 0:
+            raise RateLimitExceededException(403, 'rate limited')
+        self.remaining -= 1
+        self.calls += 1
+
+    def get_repo(self, full_name):
+        self.spend()
+        return StubRepository(self)
+
+
+class StubRepository(object):
+
+    def __init__(self, gh):
+        self.gh = gh
+
+    def get_issue(self, number):
+        self.gh.spend()
+        return StubIssue(self.gh)
+
+
+class StubIssue(object):
+
+    def __init__(self, gh):
+        self.gh = gh
+
+    def add_to_labels(self, name):
+        self.gh.spend()
+        self.gh.labels.append(name)
+
+
+class TestClientPool(unittest.TestCase):
+
+    def _pool(self, *stubs):
+        clients = [
+            PooledClient('stub %s' % i, lambda: ({}, None),
+                         factory=lambda stub=stub: stub)
+            for (i, stub) in enumerate(stubs)
+        ]
+        return ClientPool(clients)
+
+    def test_reads_spread_by_quota(self):
+        writer, a, b = StubGithub(5000), StubGithub(1000), StubGithub(500)
+        pool = self._pool(writer, a, b)
+        repo = pool.get_repo('galaxyproject/galaxy')
+        for number in range(900):
+            repo.get_issue(number)
+
+        # Nothing was exhausted, and the writer's quota was left alone even
+        # though it had the most left
+        self.assertEquals(writer.calls, 0)
+        self.assertEquals(a.remaining, b.remaining)
+        self.assertEquals(pool.rate_limiting, (5000 + 1500 - 902, 15000))
+
+        pool.report()
+        self.assertEquals([client.used for client in pool.clients],
+                          [0, a.calls, b.calls])
+
+    def test_exhausted(self):
+        now = time.time()
+        a = StubGithub(0, resettime=now + 600)
+        b = StubGithub(0, resettime=now + 60)
+        pool = self._pool(a, b)
+        self.assertEquals(pool.reader().client(), b)
+        self.assertEquals(pool.rate_limiting_resettime, now + 60)
+
+        # Once reset, a stale count of zero doesn't matter
+        c = StubGithub(0, resettime=now - 1)
+        pool = self._pool(a, b, c)
+        self.assertEquals(pool.reader().client(), c)
+
+    def test_bad_credentials(self):
+        revoked = StubGithub(5000, error=BadCredentialsException(401, 'Bad credentials'))
+        writer, reader = StubGithub(100), StubGithub(1000)
+        pool = self._pool(writer, revoked, reader)
+        pool.get_repo('galaxyproject/galaxy').get_issue(1)
+        self.assertEquals(reader.calls, 2)
+        self.assertEquals(pool.rate_limiting, (100 + 998, 10000))
+        pool.report()
+
+        # Not checked again until retry_interval has passed
+        revoked.error = None
+        self.assertEquals(pool.rate_limiting, (100 + 998, 10000))
+        pool.clients[1].failed_at -= pool.retry_interval
+        self.assertEquals(pool.rate_limiting, (100 + 5000 + 998, 15000))
+
+    def test_writes_use_writer(self):
+        writer, reader = StubGithub(100), StubGithub(1000)
+        pool = self._pool(writer, reader)
+        prf = PullRequestFilter(
+            "test_filter", [],
+            [{'action': 'assign_tag', 'action_value': 'triage'}],
+            repo=pool.get_repo('galaxyproject/galaxy'),
+            write_repo=pool.writer.get_repo('galaxyproject/galaxy'),
+        )
+        self.assertTrue(prf.apply(AttrDict({'number': 1})))
+        self.assertEquals(writer.labels, ['triage'])
+        self.assertEquals(reader.labels, [])
+
+    def test_reconnect_before_expiry(self):
+        stubs = []
+
+        def connect():
+            # Expires in a minute, i.e. due for renewal
+            return {}, datetime.datetime.utcnow() + datetime.timedelta(minutes=1)
+
+        def factory():
+            stubs.append(StubGithub(5000))
+            return stubs[-1]
+
+        client = PooledClient('installation 1', connect, factory=factory)
+        client.get_repo('galaxyproject/galaxy')
+        client.get_repo('galaxyproject/galaxy')
+        self.assertEquals(len(stubs), 2)
+
+    def test_client_per_thread(self):
+        stubs = []
+
+        def factory():
+            stubs.append(StubGithub(5000))
+            return stubs[-1]
+
+        client = PooledClient('bot', lambda: ({}, None), factory=factory)
+        client.get_repo('galaxyproject/galaxy')
+        client.get_repo('galaxyproject/galaxy')
+        thread = threading.Thread(target=client.get_repo, args=('galaxyproject/galaxy', ))
+        thread.start()
+        thread.join()
+        self.assertEquals(len(stubs), 2)
+        self.assertEquals([stub.calls for stub in stubs], [1, 1])
+
+
+class TestRepositoryConfigs(unittest.TestCase):
+
+    def test_single(self):
+        config = {'repository': {'owner': 'galaxyproject', 'name': 'galaxy'}}
+        self.assertEquals(repository_configs(config), [config['repository']])
+
+    def test_defaults(self):
+        config = {
+            'defaults': {
+                'owner': 'galaxyproject',
+                'pr_approvers': ['erasche'],
+            },
+            'repositories': [
+                {'name': 'galaxy'},
+                {'name': 'planemo', 'pr_approvers': ['jmchilton']},
+            ]
+        }
+        self.assertEquals(repository_configs(config), [
+            {'owner': 'galaxyproject', 'name': 'galaxy', 'pr_approvers': ['erasche']},
+            {'owner': 'galaxyproject', 'name': 'planemo', 'pr_approvers': ['jmchilton']},
+        ])
+
+
+class TestDecisionLog(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.NamedTemporaryFile(suffix='.jsonl').name
+        self.prf = PullRequestFilter(
+            "Add triage",
+            [{'state': 'open'}, {'title_contains__not': 'WIP'}],
+            [],
+            repo=AttrDict({'get_issue': lambda number: None}),
+            dry_run=True,
+        )
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _pr(self, title):
+        return AttrDict({'number': 12, 'state': 'open', 'title': title})
+
+    def test_explain(self):
+        decisions = DecisionLog(self.path)
+        self.prf.apply(self._pr('[WIP] Testing'),
+                       evaluation=decisions.evaluation('galaxyproject/galaxy', 12))
+        # Nothing is written until flushed
+        self.assertFalse(os.path.exists(self.path))
+        decisions.flush()
+
+        lines = explain(self.path, 12)
+        self.assertTrue(lines[0].startswith('galaxyproject/galaxy#12, latest evaluation at '))
+        self.assertEquals(len(lines), 3)
+        self.assertTrue(lines[1].startswith('  [Add triage] state "open" => True ('))
+        self.assertTrue(lines[2].endswith(', stopping'))
+
+        # Only the latest evaluation is explained
+        self.prf.apply(self._pr('Testing'),
+                       evaluation=decisions.evaluation('galaxyproject/galaxy', 12))
+        decisions.flush()
+        lines = explain(self.path, 12)
+        self.assertEquals(len(lines), 4)
+        self.assertEquals(lines[3], '  [Add triage] matched')
+
+        self.assertEquals(explain(self.path, 12, repo='galaxyproject/planemo'),
+                          ['No decisions recorded for #12'])
+        self.assertEquals(explain(self.path, 1), ['No decisions recorded for #1'])
+
+    def test_sampling(self):
+        decisions = DecisionLog(self.path, sample=0, buffer_size=2)
+        self.prf.apply(self._pr('[WIP] Testing'),
+                       evaluation=decisions.evaluation('galaxyproject/galaxy', 12))
+        self.prf.apply(self._pr('Testing'),
+                       evaluation=decisions.evaluation('galaxyproject/galaxy', 12))
+        self.prf.apply(self._pr('Testing'),
+                       evaluation=decisions.evaluation('galaxyproject/galaxy', 12))
+
+        # Only matches are recorded, and the buffer is flushed when full
+        with open(self.path, 'r') as handle:
+            self.assertEquals(len(handle.readlines()), 4)
+        decisions.flush()
+        lines = explain(self.path, 12)
+        self.assertTrue(lines[0].endswith(' was not sampled, only matches were recorded'))
+        self.assertEquals(lines[1:], ['  [Add triage] matched'])
+
+        # A later unsampled evaluation without a match is still the latest
+        self.prf.apply(self._pr('[WIP] Testing'),
+                       evaluation=decisions.evaluation('galaxyproject/galaxy', 12))
+        decisions.flush()
+        lines = explain(self.path, 12)
+        self.assertEquals(len(lines), 1)
+        self.assertTrue(lines[0].endswith(' was not sampled, only matches were recorded'))
+
+    def test_explain_missing_log(self):
+        self.assertEquals(explain(self.path, 12), ["No decision log at %s yet" % self.path])